@@ -1,6 +1,8 @@
 #!/usr/bin/env python3 # CodeDust: SKIP
 
 import argparse
+import collections
+import concurrent.futures
 import configparser
 import os
 import sys
@@ -67,6 +69,41 @@ def validate_args(args):
 ####################################################################################################
 # Inspection Rules
 ####################################################################################################
+RULE_CODES = (
+    "CD0101",
+    "CD0102",
+    "CD0103",
+    "CD0104",
+    "CD0105",
+    "CD0106",
+    "CD0201",
+    "CD0202",
+    "CD0203",
+    "CD0204",
+    "CD0205",
+    "CD0206",
+    "CD0207",
+    "CD0208",
+    "CD0209",
+    "CD0210",
+    "CD0301",
+    "CD0302",
+    "CD0303",
+    "CD0401",
+    "CD0402",
+    "CD0501",
+    "CD0502",
+)
+
+_RE_RULE_CODE = re.compile(r"CD[0-9]{4}")
+_RE_COMMA_NOSPACE = re.compile(r'\,[\w\(]')
+_RE_SEMICOLON_NOSPACE = re.compile(r'\;[\w\(]')
+_RE_EQUAL_NOSPACE_BEFORE = re.compile(r'[a-z0-9\)\]\}\"\']\=') # CodeDust: SKIP
+_RE_EQUAL_NOSPACE_AFTER = re.compile(r'\=[a-z0-9\(\[\{\"\']') # CodeDust: SKIP
+_SECTION_HEADER_CHARS = ("#", "/", "-") # CodeDust: SKIP
+_BLOCK_START_CHARS = ("{", "[", "(", "<")
+_BLOCK_END_CHARS = ("}", "]", ")", ">")
+
 def load_rules(config_file, extensions):
     static_rules = {
         "indent_size": 4,
@@ -88,7 +125,7 @@ def load_rules(config_file, extensions):
         extension_rules_from_file = config[ext] if ext in config else {}
         rules_per_extension[ext] = {**default_rules, **extension_rules_from_file}
         for rule in list(rules_per_extension[ext].keys()):
-            if re.match(r"CD[0-9]{4}", rule.upper()):
+            if _RE_RULE_CODE.match(rule.upper()):
                 bool_value = False if rules_per_extension[ext].pop(rule).lower() == "disable" else True
                 rules_per_extension[ext][rule.upper()] = bool_value
             else:
@@ -99,150 +136,217 @@ def load_rules(config_file, extensions):
 
     return rules_per_extension
 
+RulesView = collections.namedtuple(
+    "RulesView",
+    [code.lower() for code in RULE_CODES] + [
+        "indent_size",
+        "max_line_length",
+        "section_header_length",
+        "line_comment",
+        "messages",
+    ],
+)
+
+def prepare_rules(rules):
+    indent_size = rules["indent_size"]
+    max_line_length = rules["max_line_length"]
+    section_header_length = rules["section_header_length"]
+
+    messages = {
+        "CD0301": ("CD0301", f"Don't use tabs, use {indent_size} spaces."),
+        "CD0302": ("CD0302", f"Use {indent_size} spaces per indentation level."),
+        "CD0303": ("CD0303", f"Don't indent for more than one level ({indent_size} spaces) at a time."),
+        "CD0401": ("CD0401", f"Line should not be longer than {max_line_length} characters."),
+        "CD0402": ("CD0402", f"Section header should be {section_header_length} characters long."),
+    }
+
+    return RulesView(
+        *[rules.get(code) != False for code in RULE_CODES],
+        indent_size,
+        max_line_length,
+        section_header_length,
+        rules["line_comment"],
+        messages,
+    )
+
 def is_line_empty(line):
-    return line.strip() == ""
+    return not line.strip()
 
 def line_indent(line):
-    return re.match(r' *', line).end()
+    return len(line) - len(line.lstrip(" "))
 
 def inspect_line(prev_line, curr_line, next_line, rules):
+    stripped_line = curr_line.strip()
+    curr_line_empty = stripped_line == ""
+
     # Empty Lines
-    if is_line_empty(curr_line) and prev_line == None:
-        if rules.get("CD0101") != False:
+    if curr_line_empty and prev_line == None:
+        if rules.cd0101:
             yield ("CD0101", "There should be no empty lines at the start of the file.")
 
-    if is_line_empty(curr_line) and next_line == None:
-        if rules.get("CD0102") != False:
+    if curr_line_empty and next_line == None:
+        if rules.cd0102:
             yield ("CD0102", "There should be no empty lines at the end of the file.")
 
     if not curr_line.endswith("\n") and next_line == None:
-        if rules.get("CD0103") != False:
+        if rules.cd0103:
             yield ("CD0103", "There should be a line break at the end of the file.")
 
     if curr_line != None:
-        if prev_line != None and is_line_empty(prev_line) and is_line_empty(curr_line):
-            if rules.get("CD0104") != False:
+        if curr_line_empty and prev_line != None and is_line_empty(prev_line):
+            if rules.cd0104:
                 yield ("CD0104", "There should be no multiple consecutive empty lines.")
 
-        if prev_line != None and is_line_empty(curr_line) and re.search(r'[\{\[\(\<]$', prev_line.strip()):
-            if rules.get("CD0105") != False:
+        if curr_line_empty and prev_line != None and prev_line.strip().endswith(_BLOCK_START_CHARS):
+            if rules.cd0105:
                 yield ("CD0105", "There should be no empty lines at the start of a parenthesis block.")
 
-        if is_line_empty(curr_line) and next_line and re.search(r'^[\}\]\)\>]', next_line.strip()):
-            if rules.get("CD0106") != False:
+        if curr_line_empty and next_line and next_line.strip().startswith(_BLOCK_END_CHARS):
+            if rules.cd0106:
                 yield ("CD0106", "There should be no empty lines at the end of a parenthesis block.")
 
         # Spaces
-        if "  " in curr_line.strip(): # CodeDust: SKIP
-            if rules.get("CD0201") != False:
+        if "  " in stripped_line: # CodeDust: SKIP
+            if rules.cd0201:
                 yield ("CD0201", "There should be no multiple consecutive spaces in a line.")
 
         if curr_line.endswith(" \n"):
-            if rules.get("CD0202") != False:
+            if rules.cd0202:
                 yield ("CD0202", "There should be no spaces at the end of a line.")
 
-        if " ," in curr_line.strip(): # CodeDust: SKIP
-            if rules.get("CD0203") != False:
+        if " ," in stripped_line: # CodeDust: SKIP
+            if rules.cd0203:
                 yield ("CD0203", "There should be no space before comma.")
 
-        if " ;" in curr_line.strip(): # CodeDust: SKIP
-            if rules.get("CD0204") != False:
+        if " ;" in stripped_line: # CodeDust: SKIP
+            if rules.cd0204:
                 yield ("CD0204", "There should be no space before semicolon.")
 
-        if "( " in curr_line.strip(): # CodeDust: SKIP
-            if rules.get("CD0205") != False:
+        if "( " in stripped_line: # CodeDust: SKIP
+            if rules.cd0205:
                 yield ("CD0205", "There should be no space after opening parentheses.")
 
-        if " )" in curr_line.strip(): # CodeDust: SKIP
-            if rules.get("CD0206") != False:
+        if " )" in stripped_line: # CodeDust: SKIP
+            if rules.cd0206:
                 yield ("CD0206", "There should be no space before closing parentheses.")
 
-        if re.search(r'\,[\w\(]', curr_line):
-            if rules.get("CD0207") != False:
+        if "," in curr_line and _RE_COMMA_NOSPACE.search(curr_line):
+            if rules.cd0207:
                 yield ("CD0207", "There should be a space after comma.")
 
-        if re.search(r'\;[\w\(]', curr_line):
-            if rules.get("CD0208") != False:
+        if ";" in curr_line and _RE_SEMICOLON_NOSPACE.search(curr_line):
+            if rules.cd0208:
                 yield ("CD0208", "There should be a space after semicolon.")
 
-        if re.search(r'[a-z0-9\)\]\}\"\']\=', curr_line) and "====" not in curr_line:
-            if rules.get("CD0209") != False:
-                yield ("CD0209", "There should be a space before equal sign.")
+        if "=" in curr_line and "====" not in curr_line: # CodeDust: SKIP
+            if _RE_EQUAL_NOSPACE_BEFORE.search(curr_line):
+                if rules.cd0209:
+                    yield ("CD0209", "There should be a space before equal sign.")
 
-        if re.search(r'\=[a-z0-9\(\[\{\"\']', curr_line) and "====" not in curr_line: # CodeDust: SKIP
-            if rules.get("CD0210") != False:
-                yield ("CD0210", "There should be a space after equal sign.")
+            if _RE_EQUAL_NOSPACE_AFTER.search(curr_line):
+                if rules.cd0210:
+                    yield ("CD0210", "There should be a space after equal sign.")
 
         # Indentation
-        indent_size = rules["indent_size"]
+        indent_size = rules.indent_size
 
         if "\t" in curr_line:
-            if rules.get("CD0301") != False:
-                yield ("CD0301", f"Don't use tabs, use {indent_size} spaces.")
+            if rules.cd0301:
+                yield rules.messages["CD0301"]
 
-        if line_indent(curr_line) % indent_size != 0:
-            if rules.get("CD0302") != False:
-                yield ("CD0302", f"Use {indent_size} spaces per indentation level.")
+        curr_indent = line_indent(curr_line)
 
-        if prev_line != None \
+        if curr_indent % indent_size != 0:
+            if rules.cd0302:
+                yield rules.messages["CD0302"]
+
+        if curr_indent > indent_size \
+        and prev_line != None \
         and not is_line_empty(prev_line) \
-        and line_indent(curr_line) > line_indent(prev_line) \
-        and line_indent(curr_line) - line_indent(prev_line) > indent_size:
-            if rules.get("CD0303") != False:
-                yield ("CD0303", f"Don't indent for more than one level ({indent_size} spaces) at a time.")
+        and curr_indent - line_indent(prev_line) > indent_size:
+            if rules.cd0303:
+                yield rules.messages["CD0303"]
+
+        # Whitespace-only lines can't trigger any of the remaining rules.
+        if curr_line_empty:
+            return
 
         # Length
-        max_line_length = rules["max_line_length"]
+        max_line_length = rules.max_line_length
 
-        if len(curr_line.rstrip()) > max_line_length:
-            if rules.get("CD0401") != False:
-                yield ("CD0401", f"Line should not be longer than {max_line_length} characters.")
+        if rules.cd0401 and len(curr_line.rstrip()) > max_line_length:
+            yield rules.messages["CD0401"]
 
-        section_header_length = rules["section_header_length"]
-        line_comment = rules["line_comment"]
+        section_header_length = rules.section_header_length
+        line_comment = rules.line_comment
 
+        header_char = stripped_line[:1]
         is_section_header = False
-        comment_pattern = r'(^\#+$)|(^\/+$)|(^\-+$)' # CodeDust: SKIP
-        if re.search(comment_pattern, curr_line.strip()) and curr_line.strip() != line_comment:
+        if header_char in _SECTION_HEADER_CHARS \
+        and not stripped_line.strip(header_char) \
+        and stripped_line != line_comment:
             is_section_header = True
-            if len(curr_line.strip()) != section_header_length:
-                if rules.get("CD0402") != False:
-                    yield ("CD0402", f"Section header should be {section_header_length} characters long.")
+            if len(stripped_line) != section_header_length:
+                if rules.cd0402:
+                    yield rules.messages["CD0402"]
 
         # Comments
-        if curr_line.strip() != line_comment \
+        if stripped_line != line_comment \
         and line_comment \
         and len(line_comment) \
         and line_comment in curr_line \
         and not is_section_header:
             if not f"{line_comment} " in curr_line:
-                if rules.get("CD0501") != False:
+                if rules.cd0501:
                     yield ("CD0501", "There should be a space between comment syntax characters and comment text.")
 
             if not f" {line_comment}" in curr_line and not curr_line.startswith(line_comment):
-                if rules.get("CD0502") != False:
+                if rules.cd0502:
                     yield ("CD0502", "There should be a space before comment syntax characters.")
 
 ####################################################################################################
 # Execution
 ####################################################################################################
 def get_files(path, extensions, ignored_patterns):
-    for d, _, files in os.walk(path):
-        for f in files:
-            file_path = os.path.join(d, f)
-            if should_ignore(file_path, ignored_patterns):
-                continue
-            file_extension = os.path.splitext(f)[1].strip(".")
-            if file_extension in extensions:
-                yield (file_path, file_extension)
+    # Files first, then subdirectories, like os.walk.
+    try:
+        with os.scandir(path) as entries:
+            entries = list(entries)
+    except OSError:
+        return
+
+    sub_dirs = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            if not entry.is_symlink():
+                sub_dirs.append(entry.path)
+            continue
+
+        file_extension = os.path.splitext(entry.name)[1].strip(".")
+        if file_extension in extensions and not should_ignore(entry.path, ignored_patterns):
+            yield (entry.path, file_extension)
+
+    for sub_dir in sub_dirs:
+        yield from get_files(sub_dir, extensions, ignored_patterns)
 
 def should_ignore(file_path, ignored_patterns):
-    if ignored_patterns:
-        for p in ignored_patterns:
-            if re.search(p, file_path):
-                return True
+    return any(p.search(file_path) for p in ignored_patterns)
+
+def with_context(lines):
+    prev_line = None
+    lines = iter(lines)
+    curr_line = next(lines, None)
+    for next_line in lines:
+        yield (prev_line, curr_line, next_line)
+        prev_line, curr_line = curr_line, next_line
 
-    return False
+    if curr_line != None:
+        yield (prev_line, curr_line, None)
 
 def inspect_file(file_path, rules):
     try:
@@ -251,25 +355,28 @@ def inspect_file(file_path, rules):
     except Exception as e:
         raise Exception(f"Cannot read file {file_path}") from e
 
-    lines_with_context = zip(
-        [None] + lines[:-1],
-        lines,
-        lines[1:] + [None],
-    )
+    rules = prepare_rules(rules)
+
+    if rules.cd0401 and max(map(len, lines), default = 0) <= rules.max_line_length:
+        rules = rules._replace(cd0401 = False)
 
     line_number = 0
     code_dust_enabled = True
     code_dust_disabled_in_line = 0
 
-    for pl, cl, nl in lines_with_context:
+    for pl, cl, nl in with_context(lines):
         line_number += 1
-        if " CodeDust: OFF\n" in cl:
-            code_dust_enabled = False
-            code_dust_disabled_in_line = line_number
-        if " CodeDust: ON\n" in cl:
-            code_dust_enabled = True
-            code_dust_disabled_in_line = 0
-        if " CodeDust: SKIP\n" in cl or not code_dust_enabled:
+        # Directives end the line, so a line can carry only one of them.
+        if "CodeDust:" in cl:
+            if " CodeDust: OFF\n" in cl:
+                code_dust_enabled = False
+                code_dust_disabled_in_line = line_number
+            elif " CodeDust: ON\n" in cl:
+                code_dust_enabled = True
+                code_dust_disabled_in_line = 0
+            elif " CodeDust: SKIP\n" in cl:
+                continue
+        if not code_dust_enabled:
             continue
 
         for issue_code, issue_message in inspect_line(pl, cl, nl, rules):
@@ -278,6 +385,40 @@ def inspect_file(file_path, rules):
     if code_dust_disabled_in_line > 0:
         yield (code_dust_disabled_in_line, "CodeDust should be re-enabled afterwards.")
 
+worker_rules = None
+
+def init_worker(rules):
+    global worker_rules
+    worker_rules = rules
+
+def inspect_file_in_worker(file):
+    file_path, file_extension = file
+    try:
+        return list(inspect_file(file_path, worker_rules[file_extension]))
+    except Exception:
+        return None
+
+def inspect_files(files, rules):
+    if len(files) < 2:
+        for file_path, file_extension in files:
+            yield (file_path, list(inspect_file(file_path, rules[file_extension])))
+        return
+
+    workers = min(os.cpu_count() or 1, len(files))
+    if sys.platform == "win32":
+        workers = min(workers, 61) # Windows doesn't allow more than 61 worker processes.
+    chunk_size = max(1, min(16, len(files) // (workers * 4)))
+    executor = concurrent.futures.ProcessPoolExecutor(workers, initializer = init_worker, initargs = (rules,))
+    try:
+        results = executor.map(inspect_file_in_worker, files, chunksize = chunk_size)
+        for (file_path, file_extension), issues in zip(files, results):
+            if issues == None:
+                # Re-raises the worker's error in order, after the preceding files are reported.
+                issues = list(inspect_file(file_path, rules[file_extension]))
+            yield (file_path, issues)
+    finally:
+        executor.shutdown(cancel_futures = True)
+
 ####################################################################################################
 # Composition
 ####################################################################################################
@@ -287,15 +428,18 @@ if __name__ == "__main__":
 
     extensions = [e.strip() for e in args.extension if e.strip()]
     paths = args.path
-    ignored_patterns = args.ignore
+    ignored_patterns = [re.compile(p) for p in args.ignore or []]
     rules = load_rules(args.config, extensions)
 
+    files = [file for path in paths for file in get_files(path, frozenset(extensions), ignored_patterns)]
+
     issue_count = 0
-    for path in paths:
-        for file_path, file_extension in get_files(path, extensions, ignored_patterns):
-            for line_number, issue_code, issue_message in inspect_file(file_path, rules[file_extension]):
-                issue_count += 1
-                print(f"{file_path} [{line_number}]: ({issue_code}) {issue_message}")
+    for file_path, issues in inspect_files(files, rules):
+        sys.stdout.write("".join(
+            f"{file_path} [{line_number}]: ({issue_code}) {issue_message}\n"
+            for line_number, issue_code, issue_message in issues
+        ))
+        issue_count += len(issues)
 
     print(f"{issue_count} issue(s)")
     if issue_count > 0: